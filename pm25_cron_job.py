@@ -1,36 +1,105 @@
 """
 Script to read from a PM2.5 sensor via UART on a Raspberry Pi Zero W.
+Runs as a long-lived service (see pm25_monitor.service) that takes a reading every
+READ_INTERVAL seconds, keeping the UART, GPIO line, LED and data files open between reads.
 
 """
 
-import csv
-import json
+import atexit
+import mmap
 import os
+import queue
+import signal
+import struct
+import sys
+import threading
 import time
 
-import RPi.GPIO as GPIO
+import gpiod
 import serial
 from adafruit_pm25.uart import PM25_UART
+from gpiod.line import Direction, Value
 
 # ==== CONFIG ====
+GPIO_CHIP = "/dev/gpiochip0"  # GPIO character device
 SET_PIN = 17  # GPIO pin to control sensor SET
-BUFFER_PATH = "/home/username/pm25_buffer.json"
+BUFFER_PATH = "/home/username/pm25_buffer.bin"
 CSV_PATH = "/home/username/air_quality_log.csv"
+READ_INTERVAL = 300  # Seconds between readings, aligned to the wall clock
 WRITE_THRESHOLD = 6  # Write to CSV after 6 readings
+CHANGE_TOLERANCE = 1  # Readings within +/- this of the last buffered one only refresh its timestamp
 LED_PATH = "/sys/class/leds/ACT/brightness"
+DEBUG = os.environ.get("PM25_DEBUG", "") not in ("", "0")  # Set PM25_DEBUG=1 for verbose logging
 
 #  === LOGGING INITIALIZATION ====
-print("\n\n################################") # log separator
-print(f"Time: {time.asctime()}")
-print(f"\nInitialize configuration: ")
-print(f"BUFFER PATH: {BUFFER_PATH}")
-print(f"CSV PATH: {CSV_PATH}")
-print(f"DATA SAVE THRESHOLD: {WRITE_THRESHOLD}")
+# Informational output is only printed when DEBUG is set to keep log writes
+# to the SD card down. Errors and warnings are always printed.
+if DEBUG:
+    print("\n\n################################") # log separator
+    print(f"Time: {time.asctime()}")
+    print(f"\nInitialize configuration: ")
+    print(f"BUFFER PATH: {BUFFER_PATH}")
+    print(f"CSV PATH: {CSV_PATH}")
+    print(f"READ INTERVAL: {READ_INTERVAL}")
+    print(f"DATA SAVE THRESHOLD: {WRITE_THRESHOLD}")
+
+# ==== SIGNAL SETUP ====
+# Block SIGTERM (before any thread starts, so all threads inherit the mask). A stop then
+# stays pending until wait_until_next_slot collects it, so `systemctl stop` never cuts
+# a cycle off partway (e.g. between write_to_csv and clear_buffer).
+signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+
+# ==== LED SETUP ====
+# Keep the sysfs brightness file open for the life of the script so each blink
+# is a seek + write instead of a full open/write/close.
+_LED_FD = os.open(LED_PATH, os.O_WRONLY)
+atexit.register(os.close, _LED_FD)
+
+# ==== DATA FILE SETUP ====
+def open_data_file(path, flags):
+    """
+    Open (creating if needed) a data file. When the file is new, its directory is
+    fsynced too so the file itself survives a power loss, not just its contents.
+    :param path: Path of the file to open
+    :param flags: os.open flags, O_CREAT is added
+    :return: File descriptor
+    """
+    created = not os.path.exists(path)
+    fd = os.open(path, flags | os.O_CREAT, 0o644)
+    if created:
+        dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    return fd
+
+# ==== CSV SETUP ====
+# O_DSYNC makes every write durable on return (data plus the size change needed
+# to read it back) without a separate sync call or full metadata flush.
+_CSV_FD = open_data_file(CSV_PATH, os.O_WRONLY | os.O_APPEND | os.O_DSYNC)
+atexit.register(os.close, _CSV_FD)
+
+# Fixed CSV row: timestamp, pm1.0, pm2.5, pm10.0 (CRLF, matching csv.writer's existing rows)
+CSV_ROW = b"%b,%d,%d,%d\r\n"
+
+# ==== BUFFER SETUP ====
+# Fixed-size buffer record: timestamp ("%Y-%m-%d %H:%M:%S"), pm1.0, pm2.5, pm10.0
+BUFFER_RECORD = struct.Struct("<19sHHH")
+_BUFFER_FD = open_data_file(BUFFER_PATH, os.O_RDWR | os.O_APPEND | os.O_DSYNC)
+atexit.register(os.close, _BUFFER_FD)
+# Linux ignores the offset of pwrite on O_APPEND descriptors, so in-place updates need their own fd
+_BUFFER_UPDATE_FD = os.open(BUFFER_PATH, os.O_WRONLY | os.O_DSYNC)
+atexit.register(os.close, _BUFFER_UPDATE_FD)
 
 # ==== GPIO SETUP ====
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
-GPIO.setup(SET_PIN, GPIO.OUT)
+# Request the SET line through the GPIO character device; each set_value is a single ioctl
+_SET_LINE = gpiod.request_lines(
+    GPIO_CHIP,
+    consumer="pm25",
+    config={SET_PIN: gpiod.LineSettings(direction=Direction.OUTPUT, output_value=Value.INACTIVE)},
+)
+atexit.register(_SET_LINE.release)
 
 
 # ==== UART SETUP ====
@@ -40,7 +109,8 @@ try:
     uart = serial.Serial("/dev/serial0", baudrate=9600, timeout=0.25)
     pm25 = PM25_UART(uart, None)
     # DEBUG statement to check if sensor is working
-    print(f"UART: {uart} | PM25: {pm25}")
+    if DEBUG:
+        print(f"UART: {uart} | PM25: {pm25}")
 except serial.SerialException as e:
     print(f"[ERROR] Failed to open UART: {e}")
     exit(1)
@@ -52,8 +122,12 @@ def wake_sensor():
     Wake the PM2.5 sensor by setting the SET_PIN high and allowing time for warm-up.
     :return: none
     """
-    GPIO.output(SET_PIN, GPIO.HIGH)
-    print("\nSensor waking up...")
+    # The UART stays open between readings, so drop frames left over from the last cycle
+    # before waking; frames sent during this warm-up are kept for read_sensor
+    uart.reset_input_buffer()
+    _SET_LINE.set_value(SET_PIN, Value.ACTIVE)
+    if DEBUG:
+        print("\nSensor waking up...")
     time.sleep(5)  # Allow sensor to warm up
 
 def sleep_sensor():
@@ -61,8 +135,9 @@ def sleep_sensor():
     Put the PM2.5 sensor to sleep by setting the SET_PIN low.
     :return: none
     """
-    GPIO.output(SET_PIN, GPIO.LOW)
-    print("Sensor put to sleep")
+    _SET_LINE.set_value(SET_PIN, Value.INACTIVE)
+    if DEBUG:
+        print("Sensor put to sleep")
 
 # ==== LED CONTROL ====
 def blink_builtin_led(times=1, duration=1):
@@ -74,28 +149,69 @@ def blink_builtin_led(times=1, duration=1):
     :return: None
     """
     for _ in range(times):
-        with open(LED_PATH, "w") as led:
-            led.write("1")
+        os.lseek(_LED_FD, 0, os.SEEK_SET)
+        os.write(_LED_FD, b"1")
         time.sleep(duration)
-        with open(LED_PATH, "w") as led:
-            led.write("0")
+        os.lseek(_LED_FD, 0, os.SEEK_SET)
+        os.write(_LED_FD, b"0")
         time.sleep(duration)
 
+def _led_worker():
+    """
+    Run queued blink patterns one after another so they never overlap on the LED,
+    until the None sentinel queued by wait_for_led.
+    :return: none
+    """
+    while True:
+        times = _LED_QUEUE.get()
+        if times is None:
+            return
+        try:
+            blink_builtin_led(times)
+        except OSError as e:
+            print(f"[ERROR] LED blink failed: {e}")
+
+def blink_builtin_led_async(times=1):
+    """
+    Queue a blink pattern on the LED thread and return immediately, so blinking
+    overlaps with sensor and file work instead of blocking it.
+    :param times: Number of blinks
+    :return: none
+    """
+    _LED_QUEUE.put(times)
+
+def wait_for_led(timeout=15):
+    """
+    Wait for queued blink patterns to finish (leaving the LED off), giving up after
+    timeout seconds so a stuck LED can't block shutdown.
+    :param timeout: Maximum wait in seconds
+    :return: none
+    """
+    _LED_QUEUE.put(None)  # Sentinel: stop the worker once earlier patterns have run
+    _LED_THREAD.join(timeout)
+    if _LED_THREAD.is_alive():
+        print("[WARN] Timed out waiting for LED blinks to finish.")
+
+_LED_QUEUE = queue.Queue()
+_LED_THREAD = threading.Thread(target=_led_worker, daemon=True)
+_LED_THREAD.start()
+atexit.register(wait_for_led)  # Finish pending blinks before exiting
+
 # ==== SENSOR READING & DATA HANDLING ====
 def read_sensor(retries=5, delay=2):
     """
     Attempt to read from the PM2.5 sensor with specified retries.
     :param retries: Number of read attempts
-    :param delay: Delay between attempts in seconds
+    :param delay: Initial delay between attempts in seconds, backed off 1.5x per retry (max 8s)
     :return: List of [timestamp, pm1.0, pm2.5, pm10.0] or None on failure
     """
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
     for i in range(retries):
         try:
-            time.sleep(delay)
             data = pm25.read()
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            blink_builtin_led(1)  # LED blink on success
-            print(f"Successfully read sensor on (attempt {i + 1}/{retries})")
+            blink_builtin_led_async(1)  # LED blink on success
+            if DEBUG:
+                print(f"Successfully read sensor on (attempt {i + 1}/{retries})")
             return [timestamp,
                     data["pm10 standard"],
                     data["pm25 standard"],
@@ -103,39 +219,79 @@ def read_sensor(retries=5, delay=2):
         except RuntimeError as e:
             # Logging
             print(f"Sensor read failed (attempt {i+1}/{retries}): {e}")
-            print(f"Retrying...")
-            time.sleep(delay)
-            print(e)
+            if i < retries - 1:
+                if DEBUG:
+                    print(f"Retrying...")
+                time.sleep(min(delay * (1.5 ** i), 8))
     return None
 
 #==== BUFFER MANAGEMENT (short term storage) ====
 """
-Buffer management using a JSON file to store readings temporarily before writing to CSV.
+Buffer management using an append-only binary file of fixed-size records to store
+readings temporarily before writing to CSV. Each run appends one record instead of
+rewriting the whole buffer, and the file is only truncated after a CSV write.
 The purpose is to minimize frequent writes to the SD card, extending its lifespan.
 
 """
 def load_buffer():
     """
-    Load the buffer from a JSON file. If the file doesn't exist or is corrupted, return an empty list.
+    Load the buffer from the binary buffer file. A trailing partial record (e.g. from
+    a power loss mid-write) is ignored.
     :return: List of buffered readings
     """
-    if os.path.exists(BUFFER_PATH):
-        try:
-            with open(BUFFER_PATH, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            print("[WARN] Buffer file corrupted or empty. Starting fresh.")
-            return []
-    return []
+    size = os.fstat(_BUFFER_FD).st_size
+    length = size - size % BUFFER_RECORD.size
+    if not length:
+        return []  # mmap cannot map an empty range
+    # Unpack records straight from the page cache instead of copying the file into a bytes object
+    with mmap.mmap(_BUFFER_FD, length, prot=mmap.PROT_READ) as mm:
+        return [[timestamp.decode(), pm10, pm25, pm100]
+                for timestamp, pm10, pm25, pm100 in BUFFER_RECORD.iter_unpack(mm)]
+
+def append_to_buffer(reading):
+    """
+    Append a single reading to the binary buffer file.
+    :param reading: List of [timestamp, pm1.0, pm2.5, pm10.0]
+    :return: none
+    """
+    # Drop a torn record left by an interrupted write so later records stay aligned
+    size = os.fstat(_BUFFER_FD).st_size
+    if size % BUFFER_RECORD.size:
+        print("[WARN] Buffer file has a partial record. Discarding it.")
+        os.ftruncate(_BUFFER_FD, size - size % BUFFER_RECORD.size)
+    timestamp, pm10, pm25, pm100 = reading
+    os.write(_BUFFER_FD, BUFFER_RECORD.pack(timestamp.encode(), pm10, pm25, pm100))
 
-def save_buffer(buffer):
+def reading_unchanged(last, reading):
+    """
+    Check whether every PM value of a reading is within CHANGE_TOLERANCE of the last one.
+    :param last: Last buffered reading
+    :param reading: New reading
+    :return: True if the reading doesn't need a new record
     """
-    Save the current buffer to a JSON file.
-    :param buffer: List of readings to save
+    return all(abs(new - old) <= CHANGE_TOLERANCE for old, new in zip(last[1:], reading[1:]))
+
+def update_last_timestamp(buffer, timestamp):
+    """
+    Overwrite the timestamp of the last buffered record in place instead of appending
+    a near-identical reading.
+    :param buffer: Currently buffered readings, as returned by load_buffer
+    :param timestamp: New timestamp for the last record
     :return: none
     """
-    with open(BUFFER_PATH, "w") as f:
-        json.dump(buffer, f)
+    offset = (len(buffer) - 1) * BUFFER_RECORD.size
+    os.pwrite(_BUFFER_UPDATE_FD, timestamp.encode(), offset)  # Timestamp is the record's first field
+    buffer[-1][0] = timestamp
+
+def clear_buffer():
+    """
+    Empty the buffer file once its readings have been written to CSV.
+    :return: none
+    """
+    os.ftruncate(_BUFFER_FD, 0)
+    # O_DSYNC doesn't cover ftruncate; without this a power loss could bring the
+    # old readings back and they would be written to the CSV a second time
+    os.fdatasync(_BUFFER_FD)
 
 # ==== SAVE TO CSV (long-term storage) ====
 def write_to_csv(data_list):
@@ -146,45 +302,74 @@ def write_to_csv(data_list):
     """
 
     # Ensure CSV file exists, if not create and add header
-    with open(CSV_PATH, "a", newline="") as f:
-        writer = csv.writer(f)
-        # ROWS: Data
-        writer.writerows(data_list)
-    os.sync()
+    # Serialize every row in memory first so the batch lands in a single write() call
+    # ROWS: Data
+    rows = b"".join(CSV_ROW % (timestamp.encode(), pm10, pm25, pm100)
+                    for timestamp, pm10, pm25, pm100 in data_list)
+    os.write(_CSV_FD, rows)
     # Logging
-    print(f"Wrote {len(data_list)} readings to {CSV_PATH}")
+    if DEBUG:
+        print(f"Wrote {len(data_list)} readings to {CSV_PATH}")
 
-""" ==== MAIN ==== """
-try:
+# ==== SCHEDULING ====
+def wait_until_next_slot():
+    """
+    Sleep until the next multiple of READ_INTERVAL on the wall clock, so readings keep
+    the same cadence as the old */5 cron schedule. Returns early on a pending SIGTERM.
+    :return: True if it is time for the next reading, False if the service should stop
+    """
+    return signal.sigtimedwait({signal.SIGTERM}, READ_INTERVAL - time.time() % READ_INTERVAL) is None
+
+def run_cycle():
+    """
+    Take one reading and buffer it, writing the buffer to CSV once it is full.
+    :return: none
+    """
+    if DEBUG:
+        print(f"\n==== {time.asctime()} ====")
     wake_sensor()
-    reading = read_sensor()
-    sleep_sensor()
+    try:
+        reading = read_sensor()
+    finally:
+        sleep_sensor()
 
     if not reading:
         print("No reading. Skipping write.")
-        exit()
+        return
 
-    print(f"Sensor reading: {reading}")
     buffer = load_buffer()
-    buffer.append(reading)
-    print(f"\nBUFFER:")
-    for _,value in enumerate(buffer):
-        print(f"{_}.", value)
-    blink_builtin_led(2)
+    if buffer and reading_unchanged(buffer[-1], reading):
+        # Values haven't meaningfully changed; avoid an extra record on the SD card
+        update_last_timestamp(buffer, reading[0])
+    else:
+        append_to_buffer(reading)
+        buffer.append(reading)
+    if DEBUG:
+        print(f"Sensor reading: {reading}")
+        # Dump the whole buffer in one write instead of a print per row
+        sys.stdout.write("\nBUFFER:\n" + "\n".join(f"{i}. {value}" for i, value in enumerate(buffer)) + "\n")
+    blink_builtin_led_async(2)
 
     if len(buffer) >= WRITE_THRESHOLD:
         write_to_csv(buffer)
-        blink_builtin_led(3)
+        clear_buffer()
+        blink_builtin_led_async(3)
         buffer = []
 
-    save_buffer(buffer)
-
     # Debugging
-    if buffer:
-        # print(f"Last reading: {buffer[-1]}")
-        print(f"\nCURRENT THRESHOLD: {len(buffer)}")
-    else:
-        print("BUFFER is empty")
+    if DEBUG:
+        if buffer:
+            # print(f"Last reading: {buffer[-1]}")
+            print(f"\nCURRENT THRESHOLD: {len(buffer)}")
+        else:
+            print("BUFFER is empty")
 
-except Exception as e:
-    print(f"[ERROR] Unexpected error occurred: {e}")
\ No newline at end of file
+""" ==== MAIN ==== """
+try:
+    while wait_until_next_slot():
+        try:
+            run_cycle()
+        except Exception as e:
+            print(f"[ERROR] Unexpected error occurred: {e}")
+finally:
+    sleep_sensor()